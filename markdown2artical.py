@@ -6,16 +6,25 @@ import tempfile
 import os
 import io
 import json
-from bs4 import BeautifulSoup
+import functools
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from copy import deepcopy
+from xml.sax.saxutils import escape
+import lxml.html
+from lxml import etree
 import markdown as md_parser # Renamed to avoid conflict with os.markdown
 
 from docx import Document
 from docx.shared import Pt, Cm, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING, WD_BREAK
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
 from docx.enum.section import WD_SECTION_START
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+from docx.enum.table import WD_CELL_VERTICAL_ALIGNMENT
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
 from docx.text.font import Font
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
 
 # --- Constants ---
 # Font Names
@@ -40,20 +49,113 @@ LINE_SPACING_FIXED_20PT = Pt(20)
 # Margins
 MARGIN_CM = 2.5
 
-with open('./config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
+# Pre-built Length objects for the spacing/indent values used on nearly every paragraph
+_PT_CACHE = {v: Pt(v) for v in (0, 2, 5, 6, 10, 12, SIZE_THREE, 20)}
+_CM_CACHE = {v: Cm(v) for v in (0.7, -0.7, 1)} # Also the indents the element handlers set directly
+
+# Regex Patterns (compiled once, reused for every paragraph/heading)
+_ASCII_SPLIT_RE = re.compile(r'([a-zA-Z0-9\s!"#$%&\'()*+,-./:;<=>?@\[\\\]^_`{|}~]+)') # Runs laid out in the ASCII font
+_CITATION_RE = re.compile(r'(\[\^?)(\d+)(\])') # Matches [^N] or [N]
+_REFMATCH_RE = re.compile(r'(\[)(\d+(?:,\d+)*(?:-\d+)*)(\])') # Matches [1], [1,2], [1-3]
+_HEADING_NUM_RE = re.compile(r'([\d\.]+)\s*(.*)')
+_TABLE_CAP_RE = re.compile(r'(表\s*[\d\.]+)\s*(.*)')
+_TABLE_CAPTION_RE = re.compile(r'\[(表.*?)]') # "[表X.Y Caption]" in a table's first header cell
+_FIG_CAPTION_RE = re.compile(r'(图\s*[\d\.]+)\s*(.*)') # Image alt text "图X.Y Caption"
+_MERMAID_CAPTION_RE = re.compile(r'%%(图\s*[\d\.]+)\s*(.*)') # First line "%%图X.Y Caption" of a mermaid block
+_FOOTNOTE_RE = re.compile(r'\[\^(\d+)\]:\s*(.*)', re.DOTALL) # Footnote definition "[^N]: text"
+
+# HTML parsing
+_HTML_PARSER = lxml.html.HTMLParser(remove_comments=True) # Shared libxml2 parser; comments never reach the walk
+
+# Footnotes (ids and markup emitted by markdown's footnotes extension)
+_FNREF_PREFIX = 'fnref:' # id of the <sup> emitted for a reference
+_FN_ID_PREFIX = 'fn:' # id of the <li> holding a footnote's text
+_FN_TEXT_XPATH = etree.XPath(".//text()[not(ancestor::a[contains(@class, 'footnote-backref')])]") # Footnote text minus the ↩ link
+
+# Document building
+_PAGE_BREAK_XML = f'<w:p {nsdecls("w")}><w:r><w:br w:type="page"/></w:r></w:p>' # Paragraph holding only a page break
+TocEntry = namedtuple('TocEntry', 'level text') # One heading recorded for the table of contents
+
+@functools.cache
+def get_config():
+    """Loads ./config.json on first use."""
+    with open('./config.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
 
 # --- Helper Functions ---
 
-def set_run_font(run, east_asia_font=FONT_SONGTI, ascii_font=FONT_TIMES_NEW_ROMAN, size_pt=SIZE_SMALL_FOUR, bold=False, italic=False):
-    """Sets font properties for a run, handling East Asian and ASCII characters."""
-    font = run.font
-    font.name = ascii_font
-    font.element.rPr.rFonts.set(qn('w:eastAsia'), east_asia_font)
-    font.size = Pt(size_pt)
-    font.bold = bold
-    font.italic = italic
-    run.font.color.rgb = RGBColor(0, 0, 0)
+def _get_text(el):
+    """Returns the element's text with each text node stripped and joined (like bs4's get_text(strip=True))."""
+    return ''.join(t.strip() for t in el.itertext())
+
+def _has_class(el, class_name):
+    """Checks whether an HTML element carries the given CSS class."""
+    return class_name in (el.get('class') or '').split()
+
+def _append_to_body(doc, elm):
+    """Appends a block element to the end of the body, just before the trailing sectPr."""
+    body = doc.element.body
+    last = next(body.iterchildren(reversed=True), None)
+    if last is not None and last.tag == qn('w:sectPr'):
+        last.addprevious(elm) # O(1), unlike add_paragraph which searches the body for sectPr
+    else:
+        body.append(elm)
+
+def _new_p(doc):
+    """Adds an empty paragraph at the end of the body, just before the trailing sectPr."""
+    p_elm = OxmlElement('w:p')
+    _append_to_body(doc, p_elm)
+    return Paragraph(p_elm, doc._body)
+
+@functools.lru_cache(maxsize=64) # A document only uses a handful of font combinations
+def _rpr_for(east_asia_font, ascii_font, size_pt, bold=False, italic=False):
+    """Returns the <w:rPr> template for a font combination, built on first use. Copy before inserting."""
+    rFonts = OxmlElement('w:rFonts')
+    rFonts.set(qn('w:ascii'), ascii_font)
+    rFonts.set(qn('w:hAnsi'), ascii_font)
+    rFonts.set(qn('w:eastAsia'), east_asia_font)
+    rPr = OxmlElement('w:rPr')
+    rPr.append(rFonts)
+    # Only non-default toggles are written; black text comes from the document defaults
+    if bold:
+        rPr.append(OxmlElement('w:b'))
+    if italic:
+        rPr.append(OxmlElement('w:i'))
+    sz = OxmlElement('w:sz')
+    sz.set(qn('w:val'), str(int(size_pt * 2))) # Half-points
+    rPr.append(sz)
+    return rPr
+
+def _new_r(text, east_asia_font, ascii_font, size_pt, bold=False, italic=False):
+    """Builds a <w:r> element with a copy of the cached <w:rPr> for its fonts."""
+    r = OxmlElement('w:r')
+    r.append(deepcopy(_rpr_for(east_asia_font, ascii_font, size_pt, bold, italic)))
+    r.text = text # Handles tabs/newlines like add_run
+    return r
+
+def _fast_add_run(p, text, east_asia_font, ascii_font, size_pt, bold=False, italic=False):
+    """Appends a run to a paragraph, building its <w:rPr> directly from the cached template."""
+    r = _new_r(text, east_asia_font, ascii_font, size_pt, bold, italic)
+    p._p.append(r)
+    return Run(r, p)
+
+def _fast_cell_write(tc, text, east_asia_font, ascii_font, size_pt, bold=False, align_center=False):
+    """Replaces a table cell's (<w:tc>) paragraphs with one paragraph holding a single styled run."""
+    for p_elm in tc.findall(qn('w:p')):
+        tc.remove(p_elm)
+    jc = OxmlElement('w:jc')
+    jc.set(qn('w:val'), 'center' if align_center else 'left')
+    pPr = OxmlElement('w:pPr')
+    pPr.append(jc)
+    p_elm = OxmlElement('w:p')
+    p_elm.append(pPr)
+    p_elm.append(_new_r(text, east_asia_font, ascii_font, size_pt, bold))
+    tc.append(p_elm)
+
+def _cached_length(cache, unit, value):
+    """Returns the pre-built Length for `value` if there is one, else converts it with `unit` (Pt or Cm)."""
+    length = cache.get(value)
+    return length if length is not None else unit(value)
 
 def set_paragraph_formatting(paragraph, alignment=WD_ALIGN_PARAGRAPH.LEFT, 
                              line_spacing_rule=WD_LINE_SPACING.ONE_POINT_FIVE, line_spacing_val=LINE_SPACING_1_25,
@@ -74,16 +176,21 @@ def set_paragraph_formatting(paragraph, alignment=WD_ALIGN_PARAGRAPH.LEFT,
             fmt.line_spacing = line_spacing_val
 
 
-    fmt.space_before = Pt(space_before_pt)
-    fmt.space_after = Pt(space_after_pt)
+    fmt.space_before = _cached_length(_PT_CACHE, Pt, space_before_pt)
+    fmt.space_after = _cached_length(_PT_CACHE, Pt, space_after_pt)
     if first_line_indent_cm:
-        fmt.first_line_indent = Cm(first_line_indent_cm)
+        fmt.first_line_indent = _cached_length(_CM_CACHE, Cm, first_line_indent_cm)
     else:
         fmt.first_line_indent = None # Explicitly remove if not needed
         
     fmt.keep_with_next = keep_with_next
     fmt.page_break_before = page_break_before
 
+def _segment_ascii_cjk(text):
+    """Splits text into (is_ascii, segment) runs of ASCII and non-ASCII (e.g. Chinese) characters."""
+    # With one capture group, the odd indices of the split are the ASCII runs
+    return [(i & 1 == 1, part) for i, part in enumerate(_ASCII_SPLIT_RE.split(text)) if part]
+
 def add_styled_paragraph(doc, text_content, default_east_asia_font, default_ascii_font, default_size_pt,
                          alignment=WD_ALIGN_PARAGRAPH.LEFT, 
                          line_spacing_rule=WD_LINE_SPACING.MULTIPLE, line_spacing_val=LINE_SPACING_1_25,
@@ -92,7 +199,7 @@ def add_styled_paragraph(doc, text_content, default_east_asia_font, default_asci
                          fixed_line_height_pt=None, is_heading=False, heading_font_override=None,
                          is_reference=False):
     """Adds a paragraph with mixed Chinese/English font handling."""
-    p = doc.add_paragraph()
+    p = _new_p(doc)
     set_paragraph_formatting(p, alignment, line_spacing_rule, line_spacing_val,
                              space_before_pt, space_after_pt, first_line_indent_cm,
                              fixed_line_height_pt=fixed_line_height_pt)
@@ -101,120 +208,104 @@ def add_styled_paragraph(doc, text_content, default_east_asia_font, default_asci
         p.add_run(text_content)
         return p
 
-    # Regex to split by English/numbers/symbols and Chinese characters
-    # This regex attempts to capture sequences of non-Chinese and sequences of Chinese
-    parts = re.split(r'([a-zA-Z0-9\s!"#$%&\'()*+,-./:;<=>?@\[\\\]^_`{|}~]+)', text_content)
-    
-    for part in parts:
-        if not part:
-            continue
-        
-        is_ascii_part = bool(re.match(r'^[a-zA-Z0-9\s!"#$%&\'()*+,-./:;<=>?@\[\\\]^_`{|}~]+$', part))
-        
-        # Handle in-text citations like [^N] or [N]
-        citation_match = re.match(r'(\[\^?)(\d+)(\])', part) # Matches [^N] or [N]
-        ref_match_in_text = re.match(r'(\[)(\d+(?:,\d+)*(?:-\d+)*)(\])', part) # Matches [1], [1,2], [1-3]
+    # Split into runs of English/numbers/symbols and Chinese characters
+    for is_ascii_part, part in _segment_ascii_cjk(text_content):
+        if is_ascii_part and part.startswith('['):
+            # Handle in-text citations like [^N] or [N]
+            citation_match = _CITATION_RE.match(part) # Matches [^N] or [N]
+            ref_match_in_text = None if citation_match else _REFMATCH_RE.match(part) # Matches [1], [1,2], [1-3]
+        else:
+            citation_match = ref_match_in_text = None
 
         if citation_match:
             # For superscript citations like [^1] in text becoming [1] superscript
-            run = p.add_run(f"[{citation_match.group(2)}]")
-            set_run_font(run, default_east_asia_font, FONT_TIMES_NEW_ROMAN, default_size_pt, bold=bold_default)
+            run = _fast_add_run(p, f"[{citation_match.group(2)}]", default_east_asia_font, FONT_TIMES_NEW_ROMAN, default_size_pt, bold=bold_default)
             run.font.superscript = True
         elif ref_match_in_text and not is_heading : # Avoid superscripting numbers in headings like "1.1 Title"
              # For inline citations like [1,2-5]
-            run = p.add_run(f"[{ref_match_in_text.group(2)}]")
-            set_run_font(run, default_east_asia_font, FONT_TIMES_NEW_ROMAN, default_size_pt, bold=bold_default)
+            _fast_add_run(p, f"[{ref_match_in_text.group(2)}]", default_east_asia_font, FONT_TIMES_NEW_ROMAN, default_size_pt, bold=bold_default)
             # Check if it should be superscript based on context (e.g. if it was [^...] originally)
             # This part is tricky without more context from markdown parser.
             # For now, assume if it's in the format [N] it's inline, not superscript unless it was [^N]
         
         elif is_ascii_part:
-            run = p.add_run(part)
             current_font = heading_font_override if is_heading and heading_font_override else default_ascii_font
-            set_run_font(run, default_east_asia_font, current_font, default_size_pt, bold=bold_default)
-        else: # Chinese part or mixed part not caught by simple ASCII
-            # Further split this part if it's mixed and not caught by the main regex
-            sub_parts = re.split(r'([a-zA-Z0-9!"#$%&\'()*+,-./:;<=>?@\[\\\]^_`{|}~]+)', part)
-            for sub_part in sub_parts:
-                if not sub_part:
-                    continue
-                if bool(re.match(r'^[a-zA-Z0-9!"#$%&\'()*+,-./:;<=>?@\[\\\]^_`{|}~]+$', sub_part)):
-                    run = p.add_run(sub_part)
-                    current_font = heading_font_override if is_heading and heading_font_override else default_ascii_font
-                    set_run_font(run, default_east_asia_font, current_font, default_size_pt, bold=bold_default)
-                else:
-                    run = p.add_run(sub_part)
-                    current_font = heading_font_override if is_heading and heading_font_override else default_east_asia_font
-                    set_run_font(run, current_font, default_ascii_font, default_size_pt, bold=bold_default)
+            _fast_add_run(p, part, default_east_asia_font, current_font, default_size_pt, bold=bold_default)
+        else: # Chinese part
+            current_font = heading_font_override if is_heading and heading_font_override else default_east_asia_font
+            _fast_add_run(p, part, current_font, default_ascii_font, default_size_pt, bold=bold_default)
     return p
 
+def add_reference_paragraphs(doc, references):
+    """Adds the numbered reference list, built as one XML fragment and inserted in a single pass."""
+    if not references:
+        return
+    # Same formatting add_styled_paragraph(..., is_reference=True) gives: 1.25 line spacing, first line indent
+    template_p = OxmlElement('w:p')
+    set_paragraph_formatting(Paragraph(template_p, None), line_spacing_rule=WD_LINE_SPACING.MULTIPLE,
+                             line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7)
+    pPr_xml = etree.tostring(template_p.pPr, encoding='unicode')
+
+    paragraphs_xml = []
+    for ref_idx, ref in enumerate(references):
+        # Tabs and line breaks become <w:tab/>/<w:br/> like a run's text setter does
+        ref_xml = escape(f"[{ref_idx + 1}] {ref}").replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">') \
+                                                   .replace('\n', '</w:t><w:br/><w:t xml:space="preserve">')
+        paragraphs_xml.append(f'<w:p>{pPr_xml}<w:r><w:t xml:space="preserve">{ref_xml}</w:t></w:r></w:p>')
+    fragment = parse_xml(f'<w:body {nsdecls("w")}>{"".join(paragraphs_xml)}</w:body>')
+
+    for p_elm in list(fragment):
+        _append_to_body(doc, p_elm)
+
+# Per-level heading layout: paragraph style, run size, set_paragraph_formatting kwargs, how the
+# number is split from the title ('chapter' = "第X章 XXX", 'decimal' = "1.1 XXX") and TOC membership.
+# Level 5 is not a real heading and is written as a styled paragraph by add_heading.
+_HEADING_SPEC = {
+    1: dict(style='Heading 1', size=SIZE_THREE, number='chapter', in_toc=True, # Chapter: "第一章 XXX"
+            fmt=dict(alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_5, page_break_before=True, space_after_pt=12)),
+    2: dict(style='Heading 2', size=SIZE_SMALL_THREE, number='decimal', in_toc=True, # Section: "1.1 XXX"
+            fmt=dict(alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_5, space_before_pt=12, space_after_pt=6)),
+    3: dict(style='Heading 3', size=SIZE_FOUR, number='decimal', in_toc=True, # Sub-section: "1.1.1 XXX"
+            fmt=dict(alignment=WD_ALIGN_PARAGRAPH.LEFT, line_spacing_val=LINE_SPACING_1_5, space_before_pt=10, space_after_pt=5)),
+    4: dict(style=None, size=SIZE_SMALL_FOUR, number=None, in_toc=False, # "1. XXX", small four Heiti, not in TOC
+            fmt=dict(alignment=WD_ALIGN_PARAGRAPH.LEFT, line_spacing_val=LINE_SPACING_1_25, space_before_pt=5, space_after_pt=2)),
+}
+
+@functools.lru_cache(maxsize=16)
+def _heading_pPr(level):
+    """Returns the <w:pPr> template with a heading level's alignment and spacing. Copy before inserting."""
+    p_elm = OxmlElement('w:p')
+    set_paragraph_formatting(Paragraph(p_elm, None), **_HEADING_SPEC[level]['fmt'])
+    return p_elm.pPr
+
 def add_heading(doc, text, level, chapter_num_str=""):
     """Adds and styles a heading."""
-    # Clean up heading text from markdown (e.g. "1.2.3 My Title" -> "My Title")
-    clean_text = re.sub(r'^[\d\.]+\s*', '', text).strip()
-    numbered_text = text # Keep original numbering for display
-
-    if level == 1: # Chapter: "第一章 XXX"
-        p = doc.add_paragraph(style='Heading 1')
-        set_paragraph_formatting(p, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_5, page_break_before=True, space_after_pt=12) # Add some space after
-        # "第X章" part
-        run_chap_num = p.add_run(numbered_text.split(' ')[0] + (' ' if ' ' in numbered_text else '  ')) # Ensure space
-        set_run_font(run_chap_num, FONT_HEITI, FONT_TIMES_NEW_ROMAN, SIZE_THREE, bold=True)
-        # Title part
-        run_title = p.add_run(' '.join(numbered_text.split(' ')[1:]))
-        set_run_font(run_title, FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True) # Use HEITI for title too
-        return p, numbered_text # Return original numbered text for TOC
-        
-    elif level == 2: # Section: "1.1 XXX"
-        p = doc.add_paragraph(style='Heading 2')
-        set_paragraph_formatting(p, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_5, space_before_pt=12, space_after_pt=6)
-        # Number part (e.g., "1.1")
-        num_match = re.match(r'([\d\.]+)\s*(.*)', text)
-        if num_match:
-            num_part = num_match.group(1)
-            title_part = num_match.group(2)
-            run_num = p.add_run(num_part + " ") # Space after number
-            set_run_font(run_num, FONT_HEITI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_THREE, bold=True)
-            run_title = p.add_run(title_part)
-            set_run_font(run_title, FONT_HEITI, FONT_HEITI, SIZE_SMALL_THREE, bold=True)
-        else: # Fallback
-            run = p.add_run(text)
-            set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_SMALL_THREE, bold=True)
-        return p, numbered_text
-
-    elif level == 3: # Sub-section: "1.1.1 XXX"
-        p = doc.add_paragraph(style='Heading 3')
-        set_paragraph_formatting(p, alignment=WD_ALIGN_PARAGRAPH.LEFT, line_spacing_val=LINE_SPACING_1_5, space_before_pt=10, space_after_pt=5)
-        num_match = re.match(r'([\d\.]+)\s*(.*)', text)
-        if num_match:
-            num_part = num_match.group(1)
-            title_part = num_match.group(2)
-            run_num = p.add_run(num_part + " ") # Space after number
-            set_run_font(run_num, FONT_HEITI, FONT_TIMES_NEW_ROMAN, SIZE_FOUR, bold=True)
-            run_title = p.add_run(title_part)
-            set_run_font(run_title, FONT_HEITI, FONT_HEITI, SIZE_FOUR, bold=True)
-        else: # Fallback
-            run = p.add_run(text)
-            set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_FOUR, bold=True)
-        return p, numbered_text
-
-    elif level == 4: # "1. XXX"
-        p = doc.add_paragraph()
-        set_paragraph_formatting(p, alignment=WD_ALIGN_PARAGRAPH.LEFT, line_spacing_val=LINE_SPACING_1_25, space_before_pt=5, space_after_pt=2)
-        run = p.add_run(text) # Whole text is bold
-        set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_SMALL_FOUR, bold=True) # Small four, Heiti
-        return p, None # Not in TOC
-
-    elif level == 5: # "(1) XXX"
-        # These are typically inline or start a paragraph without special heading formatting beyond default text.
+    if level == 5: # "(1) XXX"
         # The prompt implies "小标题内序号用⑴、⑵、⑶……，其余层次序号依次用A、B、C……，a、b、c……"
-        # Markdown H5 `##### (1) Text` will be handled as a paragraph.
-        # We'll rely on the add_styled_paragraph for this, assuming it's just a regular paragraph start.
-        # If it needs specific styling (e.g. bold number), it should be handled during paragraph processing.
-        # For now, H5 will just become a normal paragraph.
+        # Markdown H5 `##### (1) Text` just becomes a normal paragraph.
         return add_styled_paragraph(doc, text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
                                     alignment=WD_ALIGN_PARAGRAPH.LEFT, line_spacing_val=LINE_SPACING_1_25), None
 
+    spec = _HEADING_SPEC[level]
+    size = spec['size']
+    p = _new_p(doc)
+    p._p.insert(0, deepcopy(_heading_pPr(level)))
+    if spec['style'] is not None:
+        p.style = spec['style'] # Style ids come from the document, so pStyle is not part of the template
+
+    if spec['number'] == 'chapter':
+        num_part, sep, title_part = text.partition(' ') # Single scan for "第X章" and the title
+        _fast_add_run(p, num_part + (' ' if sep else '  '), FONT_HEITI, FONT_TIMES_NEW_ROMAN, size, bold=True) # Ensure space
+        _fast_add_run(p, title_part, FONT_HEITI, FONT_HEITI, size, bold=True) # Use HEITI for title too
+    else:
+        num_match = _HEADING_NUM_RE.match(text) if spec['number'] == 'decimal' else None
+        if num_match:
+            _fast_add_run(p, num_match.group(1) + " ", FONT_HEITI, FONT_TIMES_NEW_ROMAN, size, bold=True) # Space after number
+            _fast_add_run(p, num_match.group(2), FONT_HEITI, FONT_HEITI, size, bold=True)
+        else: # No number (or level 4): one Heiti run
+            _fast_add_run(p, text, FONT_HEITI, FONT_HEITI, size, bold=True)
+    return p, (text if spec['in_toc'] else None) # Original numbered text for the TOC
+
 def convert_mermaid_to_image_mmdc(mermaid_code, temp_dir, output_format='png'):
     """Converts Mermaid code to an image file using mmdc."""
     # Create a unique filename for the mermaid source
@@ -252,60 +343,141 @@ def convert_mermaid_to_image_mmdc(mermaid_code, temp_dir, output_format='png'):
         if os.path.exists(temp_mmd_file.name):
             os.remove(temp_mmd_file.name)
 
+def convert_mermaid_batch_mmdc(mermaid_codes, temp_dir, output_format='png'):
+    """Converts several Mermaid diagrams with a single mmdc run over a generated Markdown file.
+
+    Returns a list of image paths (None where no image was produced), or None if mmdc is missing.
+    """
+    temp_md_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.md', dir=temp_dir, encoding='utf-8')
+    temp_md_file.write(''.join(f"```mermaid\n{code}\n```\n\n" for code in mermaid_codes))
+    temp_md_file.close() # Close it so mmdc can read it
+
+    # For Markdown input mmdc writes each diagram to <output name>-1.png, -2.png, ... next to the output file
+    output_base = temp_md_file.name[:-len('.md')] + '_out'
+    try:
+        toRun = ['mmdc.cmd', '-i', temp_md_file.name, '-o', output_base + '.md', '-e', output_format,
+                 '-w', '1200', '-H', '800', '--scale', '1.5']
+        process = subprocess.run(
+            toRun,
+            check=True, capture_output=True, text=True, encoding='utf-8', timeout=30 * len(mermaid_codes)
+        )
+        if process.stderr:
+            print(f"Mermaid CLI warning/info: {process.stderr}")
+    except subprocess.CalledProcessError as e:
+        print(f"Error converting Mermaid diagrams using mmdc: {e.stderr}")
+    except subprocess.TimeoutExpired:
+        print("Error: mmdc command timed out.")
+    except FileNotFoundError:
+        print("Error: 'mmdc' (Mermaid CLI) not found. Please install it and ensure it's in your PATH.")
+        return None
+    finally:
+        for leftover in (temp_md_file.name, output_base + '.md'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    image_files = []
+    for n in range(1, len(mermaid_codes) + 1):
+        image_file_path = f"{output_base}-{n}.{output_format}"
+        image_files.append(image_file_path if os.path.exists(image_file_path) else None)
+    return image_files
+
+# mmdc startup (Node + headless Chromium) dominates, so diagrams are rendered in one batched run
+# (convert_mermaid_batch_mmdc) in the background, with per-diagram retries side by side;
+# threads are enough since each one just waits on its subprocess.
+_MERMAID_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+def submit_mermaid(mermaid_code, temp_dir, output_format='png'):
+    """Schedules a Mermaid conversion on the shared pool. Returns a Future for the image path (or None)."""
+    return _MERMAID_POOL.submit(convert_mermaid_to_image_mmdc, mermaid_code, temp_dir, output_format)
+
+def _copy_future_outcome(target, done):
+    """Resolves `target` with the result or exception of the finished future `done`."""
+    exc = done.exception()
+    if exc is not None:
+        target.set_exception(exc) # Raised again by the pre handler's result(), instead of hanging there
+    else:
+        target.set_result(done.result())
+
+def _resolve_mermaid_batch(mermaid_codes, image_futures, temp_dir, output_format):
+    """Pool job: renders all diagrams in one mmdc run and resolves their futures.
+
+    Diagrams the batch did not produce (an older mmdc without Markdown input, or a broken diagram
+    failing the whole run) are retried one by one on the pool.
+    """
+    try:
+        image_files = convert_mermaid_batch_mmdc(mermaid_codes, temp_dir, output_format)
+    except Exception as e:
+        for image_future in image_futures:
+            image_future.set_exception(e)
+        return
+    if image_files is None: # mmdc missing, a per-diagram retry would fail the same way
+        for image_future in image_futures:
+            image_future.set_result(None)
+        return
+    for mermaid_code, image_future, image_file in zip(mermaid_codes, image_futures, image_files):
+        if image_file:
+            image_future.set_result(image_file)
+        else:
+            retry = submit_mermaid(mermaid_code, temp_dir, output_format)
+            retry.add_done_callback(functools.partial(_copy_future_outcome, image_future))
+
+def submit_mermaid_blocks(elements, temp_dir, output_format='png'):
+    """Submits every captioned Mermaid block in `elements` as one batched conversion without waiting on it.
+
+    Returns a dict mapping id(<pre> element) -> (caption match, Future for the image path), so the
+    block's text is only read and split once.
+    """
+    mermaid_futures = {}
+    mermaid_codes = []
+    for el in elements:
+        if el.tag != 'pre':
+            continue
+        code_tag = el.find('code')
+        if code_tag is not None and _has_class(code_tag, 'language-mermaid'):
+            code_content = code_tag.text_content()
+            caption_match = _MERMAID_CAPTION_RE.match(code_content)
+            if caption_match:
+                mermaid_codes.append('\n'.join(code_content.splitlines()[1:])) # Drop the caption line
+                mermaid_futures[id(el)] = (caption_match, Future())
+    if mermaid_codes:
+        image_futures = [image_future for _, image_future in mermaid_futures.values()]
+        _MERMAID_POOL.submit(_resolve_mermaid_batch, mermaid_codes, image_futures, temp_dir, output_format)
+    return mermaid_futures
+
+def _write_caption_only(doc, fig_num_text, caption_text):
+    """Adds a figure caption paragraph, spaced to leave an empty line after it."""
+    # "图题采用中文五号楷体，图序号采用 Times New Ramon。图题紧接图的下一行居中打印。"
+    p_caption = _new_p(doc)
+    # "图题后空一行，继续正文内容。" - done with space after the caption rather than an empty paragraph
+    set_paragraph_formatting(p_caption, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_25, space_after_pt=12)
+    _fast_add_run(p_caption, fig_num_text + " ", FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Fig num Times, e.g. "图3.2 "
+    _fast_add_run(p_caption, caption_text, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Caption Kaiti, e.g. "某结构示意图"
+
 def add_image_with_caption(doc, image_path_or_stream, caption_text, fig_num_text, image_width_cm=15):
     """Adds an image and its caption to the document."""
     try:
         if isinstance(image_path_or_stream, str) and not os.path.exists(image_path_or_stream):
             print(f"Warning: Image file not found: {image_path_or_stream}. Skipping image.")
-            # Add placeholder for caption
-            p_caption = doc.add_paragraph()
-            set_paragraph_formatting(p_caption, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_25)
-            run_fig_num = p_caption.add_run(fig_num_text + " ")
-            set_run_font(run_fig_num, FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Fig num Times
-            run_caption_text = p_caption.add_run(caption_text)
-            set_run_font(run_caption_text, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Caption Kaiti
-            add_styled_paragraph(doc, "", FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, space_after_pt=6) # Empty line after
-            return
-
-        # Add image, centered
-        # To center image, add it to a paragraph that is centered.
-        p_img = doc.add_paragraph()
-        set_paragraph_formatting(p_img, alignment=WD_ALIGN_PARAGRAPH.CENTER)
-        p_img.add_run().add_picture(image_path_or_stream, width=Cm(image_width_cm))
+        else:
+            # Add image, centered
+            # To center image, add it to a paragraph that is centered.
+            p_img = _new_p(doc)
+            set_paragraph_formatting(p_img, alignment=WD_ALIGN_PARAGRAPH.CENTER)
+            p_img.add_run().add_picture(image_path_or_stream, width=Cm(image_width_cm))
     except Exception as e:
         print(f"Error adding image '{image_path_or_stream}': {e}. Skipping image.")
-        traceback.print_exc()
-         # Add placeholder for caption even if image fails
-        p_caption = doc.add_paragraph()
-        set_paragraph_formatting(p_caption, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_25)
-        run_fig_num = p_caption.add_run(fig_num_text + " ")
-        set_run_font(run_fig_num, FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Fig num Times
-        run_caption_text = p_caption.add_run(caption_text)
-        set_run_font(run_caption_text, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Caption Kaiti
-        add_styled_paragraph(doc, "", FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, space_after_pt=6) # Empty line after
-        return
-
+        if os.environ.get('M2A_DEBUG'):
+            traceback.print_exc()
 
-    # Add caption
-    # "图题采用中文五号楷体，图序号采用 Times New Ramon。图题紧接图的下一行居中打印。"
-    p_caption = doc.add_paragraph()
-    set_paragraph_formatting(p_caption, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_25)
-    
-    run_fig_num = p_caption.add_run(fig_num_text + " ") # e.g., "图3.2 "
-    set_run_font(run_fig_num, FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Fig num Times
+    # Add caption (also kept as a placeholder when the image is missing or fails)
+    _write_caption_only(doc, fig_num_text, caption_text)
 
-    run_caption_text = p_caption.add_run(caption_text) # e.g., "某结构示意图"
-    set_run_font(run_caption_text, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Caption Kaiti
-
-    # "图题后空一行，继续正文内容。"
-    add_styled_paragraph(doc, "", FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, space_after_pt=6) # Effectively an empty line with some spacing
-
-def add_table_with_caption(doc, html_table_soup, caption_text_full):
+def add_table_with_caption(doc, html_table_el, caption_text_full):
     """Adds a Markdown table (parsed as HTML) and its caption."""
     # Extract table number and caption text
     # E.g., "[表2.1 典型虚拟化环境的物理前缀特征]虚拟化平台"
     # caption_text_full is like "表2.1 典型虚拟化环境的物理前缀特征"
-    match = re.match(r'(表\s*[\d\.]+)\s*(.*)', caption_text_full)
+    match = _TABLE_CAP_RE.match(caption_text_full)
     if not match:
         print(f"Warning: Could not parse table caption: {caption_text_full}")
         table_num_text = "表X.X"
@@ -315,20 +487,19 @@ def add_table_with_caption(doc, html_table_soup, caption_text_full):
         table_title_text = match.group(2).strip()
 
     # Add caption: "表标题采用五号楷体，表序号采用Times New Roman。"居中, 表上方
-    p_caption = doc.add_paragraph()
+    p_caption = _new_p(doc)
     set_paragraph_formatting(p_caption, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_25)
     
-    run_table_num = p_caption.add_run(table_num_text + " ")
-    set_run_font(run_table_num, FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Table num Times
+    _fast_add_run(p_caption, table_num_text + " ", FONT_KAITI, FONT_TIMES_NEW_ROMAN, SIZE_FIVE) # Table num Times
     
-    run_caption_title = p_caption.add_run(table_title_text)
-    set_run_font(run_caption_title, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Table title Kaiti
+    _fast_add_run(p_caption, table_title_text, FONT_KAITI, FONT_KAITI, SIZE_FIVE) # Table title Kaiti
 
     # Parse HTML table
-    headers = [th.get_text(strip=True) for th in html_table_soup.find_all('th')]
+    caption_bracket = f"[{caption_text_full}]" # How the caption appears inside the first header cell
+    headers = [th.text_content().strip() for th in html_table_el.xpath('.//th')]
     # Clean the first header if it contained the caption
     if headers and table_title_text in headers[0]: # A bit simplistic
-         headers[0] = headers[0].replace(f"[{caption_text_full}]", "").strip()
+         headers[0] = headers[0].replace(caption_bracket, "").strip()
          if not headers[0]: # If it was only the caption
             # Try to get it from the original markdown structure if possible, or leave as is
             # This part is tricky as the markdown parser might have altered it.
@@ -336,10 +507,8 @@ def add_table_with_caption(doc, html_table_soup, caption_text_full):
             pass
 
 
-    rows_data = []
-    for row_soup in html_table_soup.find('tbody').find_all('tr'):
-        cells = [td.get_text(strip=True) for td in row_soup.find_all('td')]
-        rows_data.append(cells)
+    rows_data = [[td.text_content().strip() for td in tr.xpath('.//td')]
+                 for tr in html_table_el.xpath('.//tbody/tr')]
 
     if not rows_data: # No body rows, maybe it's a header-only table or malformed
         if headers: # If we have headers, create a table with just the header
@@ -354,52 +523,45 @@ def add_table_with_caption(doc, html_table_soup, caption_text_full):
     table.style = 'Table Grid' # Apply a basic grid style
     table.autofit = True # Allow Word to autofit columns, or set widths manually
 
+    # Cells are written through the <w:tr>/<w:tc> elements directly; table.cell() rebuilds the whole cell grid per call
+    trs = table._tbl.tr_lst
+    n_cols = len(table.columns)
+
     # Populate header row
     if headers:
+        header_tcs = trs[0].tc_lst
         for i, header_text in enumerate(headers):
-            cell = table.cell(0, i)
+            tc = header_tcs[i]
             # Remove the caption part from the first header cell text if it's still there
-            if i == 0 and f"[{caption_text_full}]" in header_text:
-                 header_text = header_text.replace(f"[{caption_text_full}]","").strip()
+            if i == 0 and caption_bracket in header_text:
+                 header_text = header_text.replace(caption_bracket, "").strip()
             
-            # Clear existing content and add new run
-            cell.text = '' 
-            para = cell.paragraphs[0]
-            run = para.add_run(header_text)
-            set_run_font(run, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, bold=True) # Header bold
-            para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            cell.vertical_alignment = WD_ALIGN_PARAGRAPH.CENTER
+            _fast_cell_write(tc, header_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, bold=True, align_center=True) # Header bold
+            tc.get_or_add_tcPr().vAlign_val = WD_CELL_VERTICAL_ALIGNMENT.CENTER
 
 
     # Populate data rows
     for row_idx, row_cells_text in enumerate(rows_data):
         if not headers and row_idx == 0: # If no explicit headers, treat first data row as header
             # This case is less likely with the specified markdown format
+            row_tcs = trs[0].tc_lst
             for col_idx, cell_text in enumerate(row_cells_text):
-                cell = table.cell(row_idx, col_idx)
-                cell.text = ''
-                para = cell.paragraphs[0]
-                run = para.add_run(cell_text)
-                set_run_font(run, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, bold=True)
-                para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                _fast_cell_write(row_tcs[col_idx], cell_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, bold=True, align_center=True)
         else:
             actual_row_idx = row_idx + (1 if headers else 0) # Offset by 1 if headers were added
-            if actual_row_idx >= len(table.rows): # Add row if it doesn't exist
-                table.add_row()
+            if actual_row_idx >= len(trs): # Add row if it doesn't exist
+                trs.append(table.add_row()._tr)
 
+            row_tcs = trs[actual_row_idx].tc_lst
             for col_idx, cell_text in enumerate(row_cells_text):
-                if col_idx >= len(table.columns): # Should not happen if table created correctly
+                if col_idx >= n_cols: # Should not happen if table created correctly
                     print(f"Warning: cell index {col_idx} out of bounds for table {caption_text_full}")
                     continue
-                cell = table.cell(actual_row_idx, col_idx)
-                cell.text = '' # Clear existing content
-                para = cell.paragraphs[0]
                 # Add mixed font handling for table cells if needed, for now simple
-                run = para.add_run(cell_text)
-                set_run_font(run, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR)
-                para.alignment = WD_ALIGN_PARAGRAPH.LEFT # Or CENTER based on preference for data
+                _fast_cell_write(row_tcs[col_idx], cell_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR) # Left aligned
 
     # "表格后空一行，继续正文内容。"
+    # Kept as a real paragraph: it also stops Word from merging this table with a directly following one
     add_styled_paragraph(doc, "", FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, space_after_pt=6)
 
 def set_default_font_and_line_spacing(doc):
@@ -415,9 +577,17 @@ def set_default_font_and_line_spacing(doc):
     paragraph_format.line_spacing = LINE_SPACING_1_25
     paragraph_format.space_after = Pt(0) # No auto space after for normal paragraphs
 
-def add_page_number_field(paragraph):
-    """Adds a PAGE field to a paragraph (typically in footer)."""
-    run = paragraph.add_run()
+    # Black text once for the whole document instead of on every run: docDefaults covers Normal,
+    # the heading styles carry their own theme colour so they are overridden too
+    rPr_default = doc.styles.element.find(qn('w:docDefaults') + '/' + qn('w:rPrDefault') + '/' + qn('w:rPr'))
+    if rPr_default is not None:
+        rPr_default.get_or_add_color().val = RGBColor(0, 0, 0)
+    for heading_style in ('Heading 1', 'Heading 2', 'Heading 3'):
+        doc.styles[heading_style].font.color.rgb = RGBColor(0, 0, 0)
+
+def add_page_number_field(paragraph, font_size_pt=SIZE_SMALL_FIVE):
+    """Adds a PAGE field to a paragraph (typically in footer), in 宋体 of the given size."""
+    run = _fast_add_run(paragraph, '', FONT_SONGTI, FONT_SONGTI, font_size_pt) # rPr goes in before the field chars
     fldChar1 = OxmlElement('w:fldChar')
     fldChar1.set(qn('w:fldCharType'), 'begin')
     run._r.append(fldChar1)
@@ -437,10 +607,9 @@ def set_header_footer(section, header_text, footer_font_size_pt):
     header = section.header
     header.is_linked_to_previous = False # Unlink from previous section's header
     p_header = header.paragraphs[0] if header.paragraphs else header.add_paragraph()
-    p_header.text = header_text
+    p_header.clear()
+    _fast_add_run(p_header, header_text, FONT_SONGTI, FONT_SONGTI, SIZE_FIVE) # Header宋体五号
     set_paragraph_formatting(p_header, alignment=WD_ALIGN_PARAGRAPH.CENTER)
-    for run in p_header.runs: # Style existing runs or the new run
-        set_run_font(run, FONT_SONGTI, FONT_SONGTI, SIZE_FIVE) # Header宋体五号
 
     # Add header underline (bottom border to the paragraph)
     pPr = p_header._p.get_or_add_pPr()
@@ -459,39 +628,24 @@ def set_header_footer(section, header_text, footer_font_size_pt):
     p_footer = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
     p_footer.clear() # Clear any existing content
     set_paragraph_formatting(p_footer, alignment=WD_ALIGN_PARAGRAPH.CENTER)
-    # Add page number field
-    add_page_number_field(p_footer)
-    # Style the (potential) runs of the page number field - this is tricky as field is dynamic
-    # We set the paragraph font, Word should apply it.
-    for run in p_footer.runs: # Style existing runs
-        set_run_font(run, FONT_SONGTI, FONT_SONGTI, footer_font_size_pt)
-    # If no runs, set font on paragraph level (less direct for fields)
-    if not p_footer.runs:
-        # This is a bit of a hack for fields; ideally Word picks up the paragraph's default.
-        # We add a dummy run to set font, then clear it.
-        # Or, rely on Word to format the PAGE field correctly.
-        # For now, let's assume Word handles it based on paragraph's implied font.
-        # To be safe, one might need to inspect and style runs *after* Word updates fields.
-        # For script generation, setting paragraph font is the best guess.
-        pf = p_footer.paragraph_format
-        # This doesn't directly set font for the field, but it's a hint.
-        # The run added by add_page_number_field should ideally inherit.
+    # Add page number field, styled on its own run
+    add_page_number_field(p_footer, footer_font_size_pt)
 
 def add_toc_placeholder(doc):
     """Adds a paragraph indicating where the TOC should be, and a TOC field."""
     # TOC Title
-    toc_title_p = doc.add_paragraph()
+    toc_title_p = _new_p(doc)
     set_paragraph_formatting(toc_title_p, alignment=WD_ALIGN_PARAGRAPH.CENTER, line_spacing_val=LINE_SPACING_1_5, space_before_pt=12, space_after_pt=12)
-    run_toc_title = toc_title_p.add_run("目   录") # Spaced as per some conventions
-    set_run_font(run_toc_title, FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True) # Assuming Heiti Three for TOC title
+    _fast_add_run(toc_title_p, "目   录", FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True) # Spaced; assuming Heiti Three for TOC title
 
     # TOC Field (Word will populate this)
     # \o "1-3" includes heading levels 1 to 3
     # \h creates hyperlinks
     # \z hides tab leader and page number in Web layout view
     # \u uses outline levels from paragraphs
-    toc_field_p = doc.add_paragraph()
-    run = toc_field_p.add_run()
+    toc_field_p = _new_p(doc)
+    # Set TOC paragraph to a common font, Word styles will override for entries.
+    run = _fast_add_run(toc_field_p, '', FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR) # rPr goes in before the field chars
     
     fldChar_begin = OxmlElement('w:fldChar')
     fldChar_begin.set(qn('w:fldCharType'), 'begin')
@@ -515,28 +669,336 @@ def add_toc_placeholder(doc):
     # Default formatting for TOC entries (Word will apply its own styles based on Heading X styles)
     # User should ensure their Word's Heading 1, 2, 3 styles are appropriate or modify them.
     # The script primarily ensures the source headings are marked correctly.
-    # Set TOC paragraph to a common font, Word styles will override for entries.
     set_paragraph_formatting(toc_field_p, line_spacing_val=LINE_SPACING_1_25)
-    set_run_font(run, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR)
 
-ReferencesList = []
-
-def preprocess_html(soup):
-    global ReferencesList
-    for sup in soup.find_all('sup', id=re.compile(r'^fnref:\d+$')):
-        a = sup.find('a', class_='footnote-ref')
-        if a and a.string and a.string.strip().isdigit():
-            footnote_number = a.string.strip()
-            sup.replace_with(f'[^{footnote_number}]')
+def preprocess_html(tree):
+    """Turns footnote markers into [^N] text in place and returns the footnote (reference) texts."""
+    references_list = []
+    for sup in tree.xpath(f"//sup[starts-with(@id, '{_FNREF_PREFIX}')]"):
+        if not sup.get('id')[len(_FNREF_PREFIX):].isdigit(): # Only the first marker of each footnote
+            continue
+        a = sup.find("a[@class='footnote-ref']")
+        if a is not None and len(a) == 0 and a.text and a.text.strip().isdigit():
+            footnote_number = a.text.strip()
+            # Keep the marker as its own text node so _get_text strips it separately, as before
+            span = etree.Element('span')
+            span.text = f'[^{footnote_number}]'
+            span.tail = sup.tail
+            sup.getparent().replace(sup, span)
+    
+    for li in tree.xpath("//div[@class='footnote']//ol/li"):
+        p = li.find('.//p')
+        if p is not None:
+            for a in p.findall('.//a'):
+                a.drop_tree() # Removes the link but keeps the text after it
+            text = _get_text(p)
+            references_list.append(text)
+    return references_list
+
+# --- Element Handlers ---
+# Each handler takes (el, ctx); `ctx` is the dict set up in markdown_to_word: the document, the
+# current h1 section's elements, references, TOC entries and section state. h1 handlers take the
+# title text instead; _H1_DISPATCH records which of them write their section's elements themselves
+# (the abstracts pull in their paragraphs).
+
+def _emit_heading(doc, text, level, toc_items):
+    """Adds a TOC-level heading and records it in toc_items as a TocEntry."""
+    _, toc_entry_text = add_heading(doc, text, level)
+    toc_items.append(TocEntry(level, toc_entry_text))
+    return toc_entry_text
+
+def _h1_abstract_cn(title_text, ctx):
+    """Chinese abstract: title "摘 要" plus the paragraphs up to the next h1."""
+    doc = ctx['doc']
+    # Title "摘 要"
+    p_title = _new_p(doc)
+    set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_after_pt=SIZE_THREE) # Space after title
+    _fast_add_run(p_title, "摘   要", FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True) # Spaced
+    
+    # Content:楷体四号,行距固定值20磅,段首缩进
+    # Next element should be the abstract content
+    last_p = None
+    for section_el in ctx['section']: # Everything up to the next h1; only paragraphs are used
+        if section_el.tag == 'p':
+            abstract_content = _get_text(section_el)
+            #print(abstract_content)
+            last_p = add_styled_paragraph(doc, abstract_content, FONT_KAITI, FONT_KAITI, SIZE_FOUR, # Kaiti for all
+                             first_line_indent_cm=0.7, # Approx 2 chars
+                             fixed_line_height_pt=LINE_SPACING_FIXED_20PT,
+                             alignment=WD_ALIGN_PARAGRAPH.JUSTIFY) # Or LEFT
+    if last_p is not None: # With no paragraphs the title keeps its own space after
+        last_p.paragraph_format.space_after = _PT_CACHE[SIZE_SMALL_FOUR] # Blank line after Chinese Abstract content (as per "空一行")
+
+def _h1_abstract_en(title_text, ctx):
+    """English abstract, followed by the TOC and the section break before the main text."""
+    doc = ctx['doc']
+    # "空两行后" from Chinese abstract - space after the Chinese abstract + space_before on ABSTRACT
+
+    # English Title and Subtitle (assuming they are H2/H3 or paras before ABSTRACT H1 in MD)
+    # This script assumes ABSTRACT H1 is the main marker. User needs to ensure MD structure.
+    # For simplicity, we're not parsing separate Eng title/subtitle from MD here.
+
+    # "ABSTRACT" heading
+    p_title = _new_p(doc)
+    set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_before_pt=SIZE_SMALL_FOUR, space_after_pt=SIZE_THREE) # One blank line before
+    _fast_add_run(p_title, "ABSTRACT", FONT_HEITI, FONT_TIMES_NEW_ROMAN, SIZE_THREE, bold=True)
+
+    # Content: 四号, 段首缩进, 行距固定值20磅
+    for section_el in ctx['section']:
+        if section_el.tag == 'p':
+            abstract_content = _get_text(section_el)
+            #print(abstract_content)
+            add_styled_paragraph(doc, abstract_content, FONT_TIMES_NEW_ROMAN, FONT_TIMES_NEW_ROMAN, SIZE_FOUR,
+                             first_line_indent_cm=0.7, # Approx 2 chars
+                             fixed_line_height_pt=LINE_SPACING_FIXED_20PT,
+                             alignment=WD_ALIGN_PARAGRAPH.JUSTIFY) # Or LEFT
+    
+    # --- Add Table of Contents after English Abstract ---
+    add_toc_placeholder(doc)
+    
+    # --- Start new section for main text for headers/footers ---
+    # "页眉从正文开始处起到致谢结束处终止"
+    # This means Abstracts and TOC are in section 0, main text starts section 1
+    doc.add_section(WD_SECTION_START.NEW_PAGE)
+    # Apply header/footer to this new section and subsequent ones
+    # (Loop through sections later to apply)
+
+def _h1_chapter(title_text, ctx):
+    """Main text chapter "第X章 XXX"."""
+    doc = ctx['doc']
+    # The add_heading function handles the full "第X章 XXX" format (and titles slightly off it)
+    _emit_heading(doc, title_text, 1, ctx['toc_items'])
+
+def _h1_references(title_text, ctx):
+    """参考文献 on a new page, listing the footnotes collected by preprocess_html."""
+    doc = ctx['doc']
+    _append_to_body(doc, parse_xml(_PAGE_BREAK_XML)) # New page
+
+    '''
+    p_title = doc.add_paragraph()
+    set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_after_pt=Pt(SIZE_SMALL_FOUR))
+    _fast_add_run(p_title, "参考文献", FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True)
+    # References are handled by footnote processing later or specific list items
+    '''
+    _emit_heading(doc, title_text, 1, ctx['toc_items'])
+
+    add_reference_paragraphs(doc, ctx['references_list'])
+
+def _h1_thanks(title_text, ctx):
+    """致谢 title; its paragraphs are handled by the 'p' handler."""
+    doc = ctx['doc']
+    # No new page needed if it follows refs unless specified, but often is.
+    # The prompt doesn't explicitly say new page for 致谢 if after refs.
+    # Let's assume it continues unless it's the first thing in a new section.
+    '''
+    p_title = doc.add_paragraph()
+    set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_before_pt=Pt(SIZE_THREE), space_after_pt=Pt(SIZE_SMALL_FOUR))
+    _fast_add_run(p_title, "致       谢", FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True) # "致"与"谢"之间空四格 (two Chinese chars)
+    '''
+    _emit_heading(doc, title_text, 1, ctx['toc_items'])
+    # Content: 小四号宋体, 1.25倍行距
+    # Subsequent paragraphs will be handled by the 'p' tag logic.
+
+# h1 titles that are matched exactly -> (handler, whether it writes the section's elements itself
+# instead of them being walked); chapters ("第X章 ...") are recognised by _is_chapter in _handle_h1
+_H1_DISPATCH = {
+    "摘要": (_h1_abstract_cn, True),
+    "ABSTRACT": (_h1_abstract_en, True),
+    "参考文献": (_h1_references, False),
+    "致谢": (_h1_thanks, False),
+}
+
+def _owns_section(title_text):
+    """Whether an h1's handler writes its section's elements itself, so they are not walked."""
+    entry = _H1_DISPATCH.get(title_text)
+    return entry is not None and entry[1]
+
+def _is_chapter(title_text):
+    """Whether an h1 title is a chapter: "第X章 XXX", or loosely formatted ones like "第3章 ..."."""
+    return title_text.startswith("第") and "章" in title_text
+
+def _is_main_text_title(title_text):
+    """Whether an h1 belongs to the main text (chapters, 参考文献, 致谢) rather than the front matter."""
+    return title_text in ("参考文献", "致谢") or _is_chapter(title_text)
+
+def _handle_h1(title_text, ctx):
+    """Section titles (Abstracts, Main Chapters, Refs, Ack). Returns whether the section's elements were written."""
+    entry = _H1_DISPATCH.get(title_text)
+    if entry is not None:
+        handler, owns_section = entry
+        handler(title_text, ctx)
+        return owns_section
+    if _is_chapter(title_text): # Neither a known title nor a chapter: ignored
+        _h1_chapter(title_text, ctx)
+    return False
+
+# --- Main Text Headings (H2, H3, H4, H5) ---
+def _handle_h2(el, ctx):
+    doc = ctx['doc']
+    _emit_heading(doc, _get_text(el), 2, ctx['toc_items'])
+
+def _handle_h3(el, ctx):
+    doc = ctx['doc']
+    _emit_heading(doc, _get_text(el), 3, ctx['toc_items'])
+
+def _handle_h4(el, ctx): # 小节内的小标题序号用1、2、3……，小标题用黑体字单列一行
+    doc = ctx['doc']
+    add_heading(doc, _get_text(el), 4) # Handled by add_heading
+
+def _handle_h5(el, ctx): # 其余层次序号用⑴、⑵、⑶……
+    doc = ctx['doc']
+    # These are not true "headings" in Word style, but styled paragraphs.
+    # Markdown H5 -> styled paragraph
+    add_styled_paragraph(doc, _get_text(el), FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                         line_spacing_val=LINE_SPACING_1_25)
+
+# --- Paragraphs (Default text, lists, blockquotes) ---
+def _handle_p(el, ctx):
+    doc = ctx['doc']
+    has_children = len(el) > 0
+    if not has_children and (not el.text or el.text.isspace()):
+        return # Blank paragraph: nothing to write, skip the subtree searches
+    # Check for images within paragraphs
+    img_tag = el.find('.//img') if has_children else None
+    if img_tag is not None:
+        # Format: ![图2.1 某结构示意图](图片地址)
+        # alt="图2.1 某结构示意图", src="图片地址"
+        alt_text = img_tag.get('alt', '')
+        img_src = img_tag.get('src', '')
+
+        caption_match = _FIG_CAPTION_RE.match(alt_text)
+        if caption_match:
+            fig_num_text = caption_match.group(1).strip()
+            caption_content = caption_match.group(2).strip()
+            add_image_with_caption(doc, img_src, caption_content, fig_num_text)
+        else:
+            # Fallback if alt text is not in the specified "图X.Y Caption" format
+            add_image_with_caption(doc, img_src, alt_text if alt_text else "Untitled Image", "图?.?")
+    else:
+        # Regular paragraph
+        para_text = _get_text(el) # Get raw text
+        if para_text: # Avoid adding empty paragraphs unless intended for spacing
+            # Check if this paragraph is part of "致谢" content
+            # This is a heuristic; better to rely on structure if "致谢" H1 is followed by <p>
+            # For now, assume default paragraph styling.
+            # Specific styling for "致谢" content paragraphs:
+            # Check if the previous H1 was "致谢" - needs more state tracking or lookbehind in soup.
+            # Simplified: if in a section after "致谢" H1, apply.
+            # This needs refinement if other H1s can appear after "致谢".
+
+            # Default paragraph handling
+            add_styled_paragraph(doc, para_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                                 line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7) # Default indent for body
+
+# --- Lists (ul, ol) for References or general content ---
+def _handle_list(el, ctx):
+    doc = ctx['doc']
+    # This is where Footnotes from markdown `[^N]: text` often end up as list items.
+    # Or, they could be regular lists.
+    for item_idx, li in enumerate(el.findall('li')):
+        # Check if it's a reference item: a rendered footnote <li id="fn:N"> is recognised by its id alone
+        ref_num = None
+        li_id = li.get('id', '')
+        if li_id.startswith(_FN_ID_PREFIX) and li_id[len(_FN_ID_PREFIX):].isdigit():
+            ref_num = li_id[len(_FN_ID_PREFIX):]
+            ref_content = ''.join(t.strip() for t in _FN_TEXT_XPATH(li))
+        else:
+            item_text = _get_text(li)
+            # Markdown footnote style text: `[^1]: ayoubfaouzi...` becomes `[1] ayoubfaouzi...`
+            ref_match = _FOOTNOTE_RE.match(item_text) if item_text.startswith('[^') else None # Original footnote def
+            if ref_match:
+                ref_num = ref_match.group(1)
+                ref_content = ref_match.group(2).strip()
+        if ref_num is not None: # This is a bibliography item
+            # "参考文献" "小四号宋体、左起、悬挂缩进、1.25倍行距"
+            p_ref = add_styled_paragraph(doc, f"[{ref_num}] {ref_content}", 
+                                     FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                                     line_spacing_val=LINE_SPACING_1_25,
+                                     alignment=WD_ALIGN_PARAGRAPH.LEFT)
+            # Apply hanging indent
+            # Hanging indent: first_line_indent is negative, left_indent is positive
+            # python-docx uses first_line_indent for hanging if negative.
+            # A common hanging indent is 0.5 inches or 1.27 cm.
+            # Let's use a value that aligns with typical [1] numbering.
+            p_ref.paragraph_format.left_indent = _CM_CACHE[0.7] # Indent entire paragraph
+            p_ref.paragraph_format.first_line_indent = _CM_CACHE[-0.7] # Hang the first line back
+        else:
+            # Regular list item
+            prefix = f"{item_idx + 1}. " if el.tag == 'ol' else "- "
+            add_styled_paragraph(doc, prefix + item_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                                 line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7,
+                                 space_before_pt=2, space_after_pt=2)
+
+# --- Tables ---
+def _handle_table(el, ctx):
+    doc = ctx['doc']
+    # Markdown: | [表2.1 Caption]Header1 | Header2 |
+    # Caption is in the first header cell.
+    first_th = el.find('.//th')
+    caption_text_full = ""
+    if first_th is not None:
+        caption_match = _TABLE_CAPTION_RE.search(first_th.text_content()) # Same text source as the header cells
+        if caption_match:
+            caption_text_full = caption_match.group(1)
+    
+    if caption_text_full:
+        add_table_with_caption(doc, el, caption_text_full)
+    else:
+        print(f"Warning: Table found without a recognized caption format: {lxml.html.tostring(el, encoding='unicode')[:100]}")
+        # Add table without caption or with a placeholder
+        add_table_with_caption(doc, el, "表?.? Unknown Table")
+
+# --- Fenced Code Blocks (Mermaid or other code) ---
+def _handle_pre(el, ctx):
+    doc = ctx['doc']
+    code_tag = el.find('code')
+    ##code_tag = pre_tag.find('code') if pre_tag else None
     
-    for li in soup.select('div.footnote ol li'):
-        p = li.find('p')
-        if p:
-            for a in p.find_all('a'):
-                a.decompose()
-            text = p.get_text(strip=True)
-            ReferencesList.append(text)
-    return soup
+    if code_tag is not None:
+        # Check for Mermaid: ```mermaid ... ```
+        # Captioned ones (%%图3.1 某功能流程图 on the first line) were already read, matched and
+        # submitted by submit_mermaid_blocks; reuse that instead of re-reading the block
+        mermaid_job = ctx['mermaid_futures'].get(id(el))
+        if mermaid_job is not None:
+            mermaid_caption_match, image_future = mermaid_job
+            fig_num_text = mermaid_caption_match.group(1).strip()
+            caption_content = mermaid_caption_match.group(2).strip()
+            
+            # Wait for the conversion here to keep ordering
+            image_file = image_future.result()
+            if image_file:
+                add_image_with_caption(doc, image_file, caption_content, fig_num_text)
+                os.remove(image_file) # Clean up temp image
+            else:
+                print(f"Failed to convert Mermaid diagram: {fig_num_text} {caption_content}")
+                # Add placeholder text for failed mermaid
+                add_styled_paragraph(doc, f"[Failed to render Mermaid diagram: {fig_num_text} {caption_content}]",
+                                     FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                                     line_spacing_val=LINE_SPACING_1_25)
+
+        elif _has_class(code_tag, 'language-mermaid'):
+            code_content = code_tag.text_content()
+            print(f"Warning: Mermaid diagram found without '%%图X.Y Caption' comment: {code_content[:50]}")
+            # Add placeholder for mermaid without caption
+            add_styled_paragraph(doc, "[Mermaid diagram - caption not found]",
+                                 FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
+                                 line_spacing_val=LINE_SPACING_1_25)
+
+        else:
+            # Regular code block - not typically part of a thesis body, or needs specific formatting
+            # For now, just add as preformatted text (simple paragraph, monospace font)
+            code_content = code_tag.text_content() # Keep original newlines
+            p_code = add_styled_paragraph(doc, code_content, "Courier New", "Courier New", SIZE_SMALL_FOUR - 2, # Smaller for code
+                                     line_spacing_val=1.0, space_before_pt=5, space_after_pt=5)
+            p_code.paragraph_format.left_indent = _CM_CACHE[1]
+            # Could add a border or background shading if desired.
+
+# h1 titles start sections and are handled by _handle_h1 in markdown_to_word. Horizontal rules (hr)
+# have no handler: they could be a page or section break in some contexts, but are often not needed.
+_TAG_HANDLERS = {
+    'h2': _handle_h2, 'h3': _handle_h3, 'h4': _handle_h4, 'h5': _handle_h5,
+    'p': _handle_p, 'ul': _handle_list, 'ol': _handle_list, 'table': _handle_table, 'pre': _handle_pre,
+}
 
 # --- Main Processing Logic ---
 def markdown_to_word(md_content, output_docx_path, temp_dir_for_mermaid):
@@ -559,302 +1021,74 @@ def markdown_to_word(md_content, output_docx_path, temp_dir_for_mermaid):
     # 'sane_lists' for better list handling.
     # 'nl2br' if you want newlines in markdown to become <br> (thesis usually doesn't want this for paragraphs)
     html_content = md_parser.markdown(md_content, extensions=['extra', 'footnotes', 'tables', 'sane_lists', 'meta', 'toc'])
-    soup = BeautifulSoup(html_content, 'html.parser')
-    soup = preprocess_html(soup)
-
-    # State variables
-    current_chapter_num_str = ""
-    processed_elements_count = 0
-    main_text_started = False
-    toc_items = [] # For a manually generated TOC if needed, or just for tracking
+    tree = lxml.html.fragment_fromstring(html_content, create_parent='body', parser=_HTML_PARSER)
+    references_list = preprocess_html(tree)
 
     # --- Iterate through Markdown elements (now HTML) ---
-    elements = list(soup.children)
-    idx = 0
-    while idx < len(elements):
-        el = elements[idx]
-        idx += 1
-        processed_elements_count +=1
-        
-        if el.name is None: # NavigableString, likely whitespace
+    # Only h1 and the top-level block tags with a handler are kept (filtered in C by iterchildren); hr,
+    # the footnote div and anything else is dropped here.
+    elements = list(tree.iterchildren('h1', *_TAG_HANDLERS))
+
+    # Split into h1 sections in one pass: (title text or None for anything before the first h1, its elements)
+    sections = [(None, [])]
+    for el in elements:
+        if el.tag == 'h1':
+            sections.append((_get_text(el), []))
+        else:
+            sections[-1][1].append(el)
+
+    # Only diagrams in sections whose elements are walked get rendered (the abstracts keep just their
+    # paragraphs); each of those futures is waited on by the pre handler before markdown_to_word returns
+    walked_elements = [el for title_text, section_elements in sections
+                       if not _owns_section(title_text) for el in section_elements]
+    mermaid_futures = submit_mermaid_blocks(walked_elements, temp_dir_for_mermaid) # Rendered while the document is built
+
+    # The main text gets its own section (headers/footers start there). Normally the English abstract
+    # opens it; if a chapter, 参考文献 or 致谢 comes first, the break goes in before that title instead.
+    main_text_break_idx = None
+    for section_idx, (title_text, _) in enumerate(sections):
+        if title_text is None:
             continue
-
-        # --- Section Titles (Abstracts, Main Chapters, Refs, Ack) ---
-        if el.name == 'h1':
-            title_text = el.get_text(strip=True)
-            
-            if "摘要" == title_text and not "ABSTRACT" in title_text: # Chinese Abstract
-                # Title "摘 要"
-                p_title = doc.add_paragraph()
-                set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_after_pt=Pt(SIZE_THREE)) # Space after title
-                run = p_title.add_run("摘   要") # Spaced
-                set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True)
-                
-                # Content:楷体四号,行距固定值20磅,段首缩进
-                # Next element should be the abstract content
-                while idx < len(elements) and elements[idx].name != 'h1':
-                    if elements[idx].name == 'p':
-                        abstract_content = elements[idx].get_text(strip=True)
-                        #print(abstract_content)
-                        add_styled_paragraph(doc, abstract_content, FONT_KAITI, FONT_KAITI, SIZE_FOUR, # Kaiti for all
-                                         first_line_indent_cm=0.7, # Approx 2 chars
-                                         fixed_line_height_pt=LINE_SPACING_FIXED_20PT,
-                                         alignment=WD_ALIGN_PARAGRAPH.JUSTIFY) # Or LEFT
-                    idx += 1 # Consume abstract paragraph
-                doc.add_paragraph() # Blank line after Chinese Abstract content (as per "空一行") - or use space_after_pt
-
-            elif "ABSTRACT" == title_text: # English Abstract
-                # "空两行后" from Chinese abstract - effectively one blank para + space_before on ABSTRACT
-                add_styled_paragraph(doc, "", FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR, space_after_pt=Pt(SIZE_SMALL_FOUR)) # One blank line
-
-                # English Title and Subtitle (assuming they are H2/H3 or paras before ABSTRACT H1 in MD)
-                # This script assumes ABSTRACT H1 is the main marker. User needs to ensure MD structure.
-                # For simplicity, we're not parsing separate Eng title/subtitle from MD here.
-
-                # "ABSTRACT" heading
-                p_title = doc.add_paragraph()
-                set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_after_pt=Pt(SIZE_THREE))
-                run = p_title.add_run("ABSTRACT")
-                set_run_font(run, FONT_HEITI, FONT_TIMES_NEW_ROMAN, SIZE_THREE, bold=True)
-
-                idx += 1
-                # Content: 四号, 段首缩进, 行距固定值20磅
-                while idx < len(elements) and elements[idx].name != 'h1':
-                    if elements[idx].name == 'p':
-                        abstract_content = elements[idx].get_text(strip=True)
-                        #print(abstract_content)
-                        add_styled_paragraph(doc, abstract_content, FONT_TIMES_NEW_ROMAN, FONT_TIMES_NEW_ROMAN, SIZE_FOUR,
-                                         first_line_indent_cm=0.7, # Approx 2 chars
-                                         fixed_line_height_pt=LINE_SPACING_FIXED_20PT,
-                                         alignment=WD_ALIGN_PARAGRAPH.JUSTIFY) # Or LEFT
-                    idx += 1
-                
-                # --- Add Table of Contents after English Abstract ---
-                add_toc_placeholder(doc)
-                
-                # --- Start new section for main text for headers/footers ---
-                # "页眉从正文开始处起到致谢结束处终止"
-                # This means Abstracts and TOC are in section 0, main text starts section 1
+        if title_text == "ABSTRACT":
+            break
+        if _is_main_text_title(title_text):
+            main_text_break_idx = section_idx
+            break
+
+    # Context shared with the element handlers
+    ctx = {
+        'doc': doc,
+        'section': [], # Elements of the h1 section being written
+        'references_list': references_list,
+        'mermaid_futures': mermaid_futures,
+        'toc_items': [], # TocEntry per heading, for a manually generated TOC if needed, or just for tracking
+    }
+    tag_handlers = _TAG_HANDLERS # Local names for the per-element lookups
+    handle_h1 = _handle_h1
+    try:
+        for section_idx, (title_text, section_elements) in enumerate(sections):
+            ctx['section'] = section_elements
+            if section_idx == main_text_break_idx:
                 doc.add_section(WD_SECTION_START.NEW_PAGE)
-                main_text_started = True
-                # Apply header/footer to this new section and subsequent ones
-                # (Loop through sections later to apply)
-
-            elif title_text.startswith("第") and "章" in title_text: # Main Text Chapter
-                if not main_text_started: # If somehow first chapter appears before ABSTRACT is done
-                    doc.add_section(WD_SECTION_START.NEW_PAGE)
-                    main_text_started = True
-
-                chap_match = re.match(r"(第[一二三四五六七八九十百]+章)\s*(.*)", title_text)
-                if chap_match:
-                    current_chapter_num_str = chap_match.group(1) # e.g. "第一章"
-                    # The add_heading function handles the full "第X章 XXX" format
-                    _, toc_entry_text = add_heading(doc, title_text, 1)
-                    toc_items.append({'level': 1, 'text': toc_entry_text, 'page': '?'})
-                else: # Fallback if format is slightly off
-                     _, toc_entry_text = add_heading(doc, title_text, 1) # Fallback
-                     toc_items.append({'level': 1, 'text': toc_entry_text, 'page': '?'})
-
-
-            elif "参考文献" == title_text:
-                if not main_text_started: # Should not happen
-                    doc.add_section(WD_SECTION_START.NEW_PAGE)
-                    main_text_started = True
-                doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE) # New page
-
-                '''
-                p_title = doc.add_paragraph()
-                set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_after_pt=Pt(SIZE_SMALL_FOUR))
-                run = p_title.add_run("参考文献")
-                set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True)
-                # References are handled by footnote processing later or specific list items
-                '''
-                _, toc_entry_text = add_heading(doc, title_text, 1)
-                toc_items.append({'level': 1, 'text': toc_entry_text, 'page': '?'})
-
-                for ref_idx, ref in enumerate(ReferencesList):
-                    ref_text = f"[{ref_idx + 1}] {ref}"
-                    #print(ref_text)
-                    add_styled_paragraph(doc, ref_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                         line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7, is_reference=True)
-
-            elif "致谢" == title_text:
-                if not main_text_started: # Should not happen
-                    doc.add_section(WD_SECTION_START.NEW_PAGE)
-                    main_text_started = True
-                # No new page needed if it follows refs unless specified, but often is.
-                # The prompt doesn't explicitly say new page for 致谢 if after refs.
-                # Let's assume it continues unless it's the first thing in a new section.
-                '''
-                p_title = doc.add_paragraph()
-                set_paragraph_formatting(p_title, alignment=WD_ALIGN_PARAGRAPH.CENTER, space_before_pt=Pt(SIZE_THREE), space_after_pt=Pt(SIZE_SMALL_FOUR))
-                run = p_title.add_run("致       谢") # "致"与"谢"之间空四格 (two Chinese chars)
-                set_run_font(run, FONT_HEITI, FONT_HEITI, SIZE_THREE, bold=True)
-                '''
-                _, toc_entry_text = add_heading(doc, title_text, 1)
-                toc_items.append({'level': 1, 'text': toc_entry_text, 'page': '?'})
-                # Content: 小四号宋体, 1.25倍行距
-                # Subsequent paragraphs will be handled by the 'p' tag logic.
-
-        # --- Main Text Headings (H2, H3, H4, H5) ---
-        elif el.name == 'h2':
-            _, toc_entry_text = add_heading(doc, el.get_text(strip=True), 2)
-            toc_items.append({'level': 2, 'text': toc_entry_text, 'page': '?'})
-        elif el.name == 'h3':
-            _, toc_entry_text = add_heading(doc, el.get_text(strip=True), 3)
-            toc_items.append({'level': 3, 'text': toc_entry_text, 'page': '?'})
-        elif el.name == 'h4': # 小节内的小标题序号用1、2、3……，小标题用黑体字单列一行
-            add_heading(doc, el.get_text(strip=True), 4) # Handled by add_heading
-        elif el.name == 'h5': # 其余层次序号用⑴、⑵、⑶……
-             # These are not true "headings" in Word style, but styled paragraphs.
-             # Markdown H5 -> styled paragraph
-            add_styled_paragraph(doc, el.get_text(strip=True), FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                 line_spacing_val=LINE_SPACING_1_25)
-
-
-        # --- Paragraphs (Default text, lists, blockquotes) ---
-        elif el.name == 'p':
-            # Check for images within paragraphs
-            img_tag = el.find('img')
-            if img_tag:
-                # Format: ![图2.1 某结构示意图](图片地址)
-                # alt="图2.1 某结构示意图", src="图片地址"
-                alt_text = img_tag.get('alt', '')
-                img_src = img_tag.get('src', '')
-
-                caption_match = re.match(r'(图\s*[\d\.]+)\s*(.*)', alt_text)
-                if caption_match:
-                    fig_num_text = caption_match.group(1).strip()
-                    caption_content = caption_match.group(2).strip()
-                    add_image_with_caption(doc, img_src, caption_content, fig_num_text)
-                else:
-                    # Fallback if alt text is not in the specified "图X.Y Caption" format
-                    add_image_with_caption(doc, img_src, alt_text if alt_text else "Untitled Image", "图?.?")
-            else:
-                # Regular paragraph
-                para_text = el.get_text(strip=True) # Get raw text
-                if para_text: # Avoid adding empty paragraphs unless intended for spacing
-                    # Check if this paragraph is part of "致谢" content
-                    # This is a heuristic; better to rely on structure if "致谢" H1 is followed by <p>
-                    # For now, assume default paragraph styling.
-                    # Specific styling for "致谢" content paragraphs:
-                    # Check if the previous H1 was "致谢" - needs more state tracking or lookbehind in soup.
-                    # Simplified: if in a section after "致谢" H1, apply.
-                    # This needs refinement if other H1s can appear after "致谢".
-
-                    # Default paragraph handling
-                    add_styled_paragraph(doc, para_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                         line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7) # Default indent for body
-        
-        # --- Lists (ul, ol) for References or general content ---
-        elif el.name in ['ul', 'ol']:
-            # This is where Footnotes from markdown `[^N]: text` often end up as list items.
-            # Or, they could be regular lists.
-            for item_idx, li in enumerate(el.find_all('li', recursive=False)):
-                item_text = li.get_text(strip=True)
-                # Check if it's a reference item (markdown footnote style)
-                # `[^1]: ayoubfaouzi...` becomes `[1] ayoubfaouzi...`
-                ref_match = re.match(r'\[\^(\d+)\]:\s*(.*)', item_text, re.DOTALL) # Original footnote def
-                if ref_match: # This is a bibliography item
-                    ref_num = ref_match.group(1)
-                    ref_content = ref_match.group(2).strip()
-                    
-                    # "参考文献" "小四号宋体、左起、悬挂缩进、1.25倍行距"
-                    p_ref = add_styled_paragraph(doc, f"[{ref_num}] {ref_content}", 
-                                             FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                             line_spacing_val=LINE_SPACING_1_25,
-                                             alignment=WD_ALIGN_PARAGRAPH.LEFT)
-                    # Apply hanging indent
-                    # Hanging indent: first_line_indent is negative, left_indent is positive
-                    # python-docx uses first_line_indent for hanging if negative.
-                    # A common hanging indent is 0.5 inches or 1.27 cm.
-                    # Let's use a value that aligns with typical [1] numbering.
-                    p_ref.paragraph_format.left_indent = Cm(0.7) # Indent entire paragraph
-                    p_ref.paragraph_format.first_line_indent = Cm(-0.7) # Hang the first line back
-                else:
-                    # Regular list item
-                    prefix = f"{item_idx + 1}. " if el.name == 'ol' else "- "
-                    add_styled_paragraph(doc, prefix + item_text, FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                         line_spacing_val=LINE_SPACING_1_25, first_line_indent_cm=0.7,
-                                         space_before_pt=2, space_after_pt=2)
-
-
-        # --- Tables ---
-        elif el.name == 'table':
-            # Markdown: | [表2.1 Caption]Header1 | Header2 |
-            # Caption is in the first header cell.
-            first_th = el.find('th')
-            caption_text_full = ""
-            if first_th:
-                caption_match = re.search(r'\[(表.*?)]', first_th.get_text(strip=True))
-                if caption_match:
-                    caption_text_full = caption_match.group(1)
-            
-            if caption_text_full:
-                add_table_with_caption(doc, el, caption_text_full)
-            else:
-                print(f"Warning: Table found without a recognized caption format: {el.prettify()[:100]}")
-                # Add table without caption or with a placeholder
-                add_table_with_caption(doc, el, "表?.? Unknown Table")
-
+            if title_text is not None and handle_h1(title_text, ctx):
+                continue # The h1 handler already wrote this section (abstracts)
+            for el in section_elements:
+                tag_handlers[el.tag](el, ctx)
+    finally:
+        # If a handler raised, mmdc jobs may still be writing into temp_dir_for_mermaid; let them
+        # finish before the caller deletes it (a no-op once every diagram was placed)
+        wait([image_future for _, image_future in mermaid_futures.values()])
 
-        # --- Fenced Code Blocks (Mermaid or other code) ---
-        elif el.name == 'pre':
-            code_tag = el.find('code')
-            ##code_tag = pre_tag.find('code') if pre_tag else None
-            
-            if code_tag:
-                code_content = code_tag.get_text() # Keep original newlines
-                # Check for Mermaid: ```mermaid ... ```
-                # The 'language-mermaid' class might be on `code` or `pre`
-                is_mermaid = 'language-mermaid' in code_tag.get('class', [])
-
-                if is_mermaid:
-                    # Extract caption: %%图3.1 某功能流程图
-                    mermaid_caption_match = re.match(r'%%(图\s*[\d\.]+)\s*(.*)', code_content) # From first line
-                    if mermaid_caption_match:
-                        fig_num_text = mermaid_caption_match.group(1).strip()
-                        caption_content = mermaid_caption_match.group(2).strip()
-                        
-                        # Remove the caption line from the mermaid code itself
-                        mermaid_code_for_render = '\n'.join(code_content.splitlines()[1:])
-                        
-                        #print(f'idx = {idx}')
-                        image_file = convert_mermaid_to_image_mmdc(mermaid_code_for_render, temp_dir_for_mermaid)
-                        if image_file:
-                            add_image_with_caption(doc, image_file, caption_content, fig_num_text)
-                            os.remove(image_file) # Clean up temp image
-                        else:
-                            print(f"Failed to convert Mermaid diagram: {fig_num_text} {caption_content}")
-                            # Add placeholder text for failed mermaid
-                            add_styled_paragraph(doc, f"[Failed to render Mermaid diagram: {fig_num_text} {caption_content}]",
-                                                 FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                                 line_spacing_val=LINE_SPACING_1_25)
-                    else:
-                        print(f"Warning: Mermaid diagram found without '%%图X.Y Caption' comment: {code_content[:50]}")
-                        # Add placeholder for mermaid without caption
-                        add_styled_paragraph(doc, "[Mermaid diagram - caption not found]",
-                                             FONT_SONGTI, FONT_TIMES_NEW_ROMAN, SIZE_SMALL_FOUR,
-                                             line_spacing_val=LINE_SPACING_1_25)
-
-                else:
-                    # Regular code block - not typically part of a thesis body, or needs specific formatting
-                    # For now, just add as preformatted text (simple paragraph, monospace font)
-                    p_code = add_styled_paragraph(doc, code_content, "Courier New", "Courier New", SIZE_SMALL_FOUR - 2, # Smaller for code
-                                             line_spacing_val=1.0, space_before_pt=5, space_after_pt=5)
-                    p_code.paragraph_format.left_indent = Cm(1)
-                    # Could add a border or background shading if desired.
-        elif el.name == 'hr':
-            # Horizontal rule, could be a page break or section break in some contexts
-            # For now, just add a paragraph with a symbolic representation or ignore
-            # doc.add_paragraph("--- horizontal rule ---")
-            pass # Often not needed in final doc
+    # The HTML and its tree are no longer needed: drop every reference (any element proxy keeps the whole
+    # lxml tree alive) so they are freed before save() serialises the document
+    el = section_elements = None
+    del html_content, tree, elements, sections, walked_elements, ctx
 
     # --- Apply Headers and Footers ---
     # Header: custom header, 宋体五号居中, 加页眉线
     # Page numbers: 宋体小五号, 居中
     # Scope: From main text start (section 1 onwards) to acknowledgments end.
-    header_text_content = config['Artical-Header']
+    header_text_content = get_config()['Artical-Header']
     for i, section_to_modify in enumerate(doc.sections):
         if i == 0: # Section 0 (Abstracts, TOC) - no header/footer or different
             section_to_modify.header.is_linked_to_previous = True # Link to default empty or make it distinct